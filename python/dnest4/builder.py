@@ -1,15 +1,32 @@
+import functools
+import os
+import re
 import numpy as np
+from textwrap import indent
 from .distributions import *
 
 __all__ = ["Model", "Node", "data_declaration", "data_definition",\
             "generate_h", "generate_cpp"]
 
+# Matches the {NAME} placeholders in MyModel.h.template and MyModel.cpp.template
+_placeholder = re.compile(r"\{([A-Z_]+)\}")
+
 class Model:
     def __init__(self):
         self.nodes = []
         self.indices = {}
         self.num_params = 0
 
+        # The nodes again, bucketed once here rather than filtered in every
+        # code generating method. _unobserved keeps insertion order because
+        # Delta nodes may refer to anything defined before them.
+        self._unobserved = []
+        self._params = []
+        self._observed = []
+
+        # Checked data entries, see set_data
+        self._data = []
+
     def __getitem__(self, item):
         return self.nodes[self.indices[item]]
 
@@ -17,90 +34,118 @@ class Model:
         self.nodes.append(node)
         self.indices[node.name] = len(self.nodes)-1
 
-        if node.observed == False and type(node.distribution) != Delta:
-            self.num_params += 1
+        is_delta = type(node.distribution) is Delta
+        if node.observed:
+            if not is_delta:
+                self._observed.append(node)
+        else:
+            self._unobserved.append(node)
+            if not is_delta:
+                self._params.append(node)
+                self.num_params += 1
+
+    def set_data(self, data):
+        """
+        Attach the data (and prior information) dictionary to the model.
+        The type of every entry is checked here, once, so that generating
+        the code doesn't need to.
+        """
+        self._data = _data_entries(data)
 
     def declaration(self):
-        s = ""
-        for node in self.nodes:
-            if not node.observed:
-                if type(node.distribution) is Delta:
-                    s += node.cpp_type +\
-                                " {x};\n".format(x=node.name)
-                else:
-                    s += node.cpp_type +\
-                                " _{x}, {x};\n".format(x=node.name)
-
-        return s
+        parts = []
+        for node in self._unobserved:
+            if type(node.distribution) is Delta:
+                parts.append(node.cpp_type + " {x};\n".format(x=node.name))
+            else:
+                parts.append(node.cpp_type +\
+                                " _{x}, {x};\n".format(x=node.name))
+
+        return "".join(parts)
 
     def from_prior(self):
-        s = ""
-        for node in self.nodes:
-            if node.observed == False and type(node.distribution) is not Delta:
-                s += "_{x} = rng.rand();\n".format(x=node.name)
-        s += "\n"
-        for node in self.nodes:
-            if node.observed == False:
-                s += "" + node.distribution.from_uniform().format(x=node.name)
-        return s
+        parts = []
+        for node in self._params:
+            parts.append("_{x} = rng.rand();\n".format(x=node.name))
+        parts.append("\n")
+        for node in self._unobserved:
+            parts.append(node.from_uniform())
+        return "".join(parts)
 
     def perturb(self):
-        s = ""
-        s += "double logH = 0.0;\n\n"
-        s += "int which;\n"
-        s += "int reps = 1;\n"
-        s += "if(rng.rand() <= 0.5)\n"
-        s += "    reps = (int)pow(10.0, 2*rng.rand());\n"
-        s += "for(int i=0; i<reps; ++i)\n"
-        s += "{\n"
-        s += "which = rng.rand_int(" + str(self.num_params) + ");\n"
-
-        k = 0
-        for node in self.nodes:
-            if node.observed == False and type(node.distribution) != Delta:
-                s += "if(which == {k})\n{{\n".format(k=k)
-                s += "_{x}".format(x=node.name) + " += rng.randh();\n"
-                s += "DNest4::wrap(_{x}, 0.0, 1.0);\n}}\n"\
-                                .format(x=node.name);
-                k += 1
-
-        s += "}\n\n"
-        for node in self.nodes:
-            if node.observed == False:
-                s += "" + node.distribution.from_uniform()\
-                                        .format(x=node.name)
-
-        s += "\nreturn logH;\n\n"
-        return s
+        parts = []
+        parts.append("double logH = 0.0;\n\n")
+        if self.num_params > 1:
+            parts.append("int which;\n")
+        parts.append("int reps = 1;\n")
+        parts.append("if(rng.rand() <= 0.5)\n")
+        parts.append("    reps = (int)pow(10.0, 2*rng.rand());\n")
+        parts.append("for(int i=0; i<reps; ++i)\n")
+        parts.append("{\n")
+
+        if self.num_params == 1:
+            # The number of parameters is known here, so with only one of
+            # them there is no need to draw which one to move
+            parts.append(self._params[0].perturb())
+        elif self.num_params > 1:
+            parts.append("which = rng.rand_int("\
+                                + str(self.num_params) + ");\n")
+
+            # A switch lets the compiler dispatch with a jump table instead of
+            # testing every parameter index in turn
+            parts.append("switch(which)\n{\n")
+            for k, node in enumerate(self._params):
+                parts.append("case {k}:\n".format(k=k))
+                parts.append(indent(node.perturb(), "    "))
+                parts.append("    break;\n")
+            parts.append("}\n")
+
+        parts.append("}\n\n")
+        for node in self._unobserved:
+            parts.append(node.from_uniform())
+
+        parts.append("\nreturn logH;\n\n")
+        return "".join(parts)
 
     def log_likelihood(self):
-        s = ""
-        s += "double logp = 0.0;\n\n"
-        for node in self.nodes:
-            if node.observed and type(node.distribution) != Delta:
-                
-                s += node.distribution.log_prob().format(x=node.name)
-        s += "if(std::isnan(logp) || std::isinf(logp))\n"
-        s += "    logp = -1E300;\n"
-        s += "\nreturn logp;\n"
-        return s
+        parts = []
+        parts.append("double logp = 0.0;\n\n")
+
+        # Normal data sharing the same normalising term (e.g. the same noise
+        # sd) get it added once, multiplied by their number, rather than
+        # evaluating it again in every line
+        counts = {}
+        log_norms = []
+        for node in self._observed:
+            log_norm = None
+            if type(node.distribution) is Normal:
+                log_norm = node.distribution.log_norm()
+                counts[log_norm] = counts.get(log_norm, 0) + 1
+            log_norms.append(log_norm)
+        for log_norm, count in counts.items():
+            if count > 1:
+                parts.append("logp += {n}*({c});\n"\
+                                .format(n=count, c=log_norm))
+
+        for node, log_norm in zip(self._observed, log_norms):
+            if counts.get(log_norm, 0) > 1:
+                parts.append("logp -= " + node.log_kernel() + ";\n")
+            else:
+                parts.append(node.log_prob())
+        parts.append("if(std::isnan(logp) || std::isinf(logp))\n")
+        parts.append("    logp = -1E300;\n")
+        parts.append("\nreturn logp;\n")
+        return "".join(parts)
 
     def print(self):
-        s = ""
-        for node in self.nodes:
-            if not node.observed:
-                s += "out<<" + node.name + "<<\' \';\n"
-        return s
+        parts = []
+        for node in self._unobserved:
+            parts.append("out<<" + node.name + "<<\' \';\n")
+        return "".join(parts)
 
     def description(self):
-        s = ""
-        s += "return string(\""
-        for node in self.nodes:
-            if not node.observed:
-                s += node.name + ", "
-        s = s[0:-2]
-        s += "\");"
-        return s
+        names = ", ".join(node.name for node in self._unobserved)
+        return "return string(\"" + names + "\");"
 
 
 class Node:
@@ -113,98 +158,148 @@ class Node:
         self.distribution = distribution
         self.observed = observed
 
-def data_declaration(data):
-    # Static variables for anything which is data or prior info
-    s = ""
-
-    for name in data:
-        if type(data[name]) == int:
-            s += "static const int " + name + ";\n"
-        elif type(data[name]) == float:
-            s += "static const double " + name + ";\n"
-        elif type(data[name] == np.array) and\
-            data[name].dtype.name == 'int64':
-            for i in range(0, len(data[name])):
-                s += "static const int " + name + str(i) + ";\n"
-        elif type(data[name] == np.array) and\
-            data[name].dtype.name == 'float64':
-            for i in range(0, len(data[name])):
-                s += "static const double " + name + str(i) + ";\n"
-
-    return s
+        # The name and distribution are fixed from here on, so generate all
+        # of this node's code now. Code generation for the Model then only
+        # joins these strings together.
+        self._from_uniform = None
+        self._log_prob = None
+        self._log_kernel = None
+        if hasattr(distribution, "from_uniform"):
+            self._from_uniform = distribution.from_uniform().format(x=name)
+        if hasattr(distribution, "log_prob"):
+            self._log_prob = distribution.log_prob().format(x=name)
+        if hasattr(distribution, "log_kernel"):
+            self._log_kernel = distribution.log_kernel().format(x=name)
+        self._perturb = "_{x} += rng.randh();\n"\
+                        "DNest4::wrap(_{x}, 0.0, 1.0);\n".format(x=name)
+
+    def from_uniform(self):
+        """
+        Code that sets the node from its underlying U(0, 1) variable.
+        """
+        return self._from_uniform
+
+    def log_prob(self):
+        """
+        Code that adds the node's log density to logp.
+        """
+        return self._log_prob
+
+    def log_kernel(self):
+        """
+        The part of log_prob that depends on the node's value, for
+        distributions that split it out.
+        """
+        return self._log_kernel
+
+    def perturb(self):
+        """
+        Code for a proposal that moves the node's U(0, 1) variable.
+        """
+        return self._perturb
+
+def _data_entries(data):
+    """
+    Check the data (and prior information) once, returning a list of
+    (name, cpp_type, value) where value is a Python int or float, or a
+    list of them for an array.
+    """
+    entries = []
+    for name, datum in data.items():
+        if isinstance(datum, np.ndarray):
+            if datum.dtype.kind in "iu":
+                cpp_type = "int"
+            elif datum.dtype.kind == "f":
+                cpp_type = "double"
+            else:
+                raise TypeError("unsupported dtype {0} for data '{1}'"\
+                                    .format(datum.dtype, name))
+            if datum.ndim != 1:
+                raise ValueError("data '{0}' must be one dimensional"\
+                                    .format(name))
+            # tolist() converts every element to a Python scalar in one go
+            entries.append((name, cpp_type, datum.tolist()))
+        elif isinstance(datum, (int, np.integer)):
+            entries.append((name, "int", int(datum)))
+        elif isinstance(datum, (float, np.floating)):
+            entries.append((name, "double", float(datum)))
+        else:
+            raise TypeError("unsupported type {0} for data '{1}'"\
+                                .format(type(datum).__name__, name))
+    return entries
 
 def data_declaration(data):
+    return "".join(_data_declaration(_data_entries(data)))
+
+def _data_declaration(entries):
     # Static variables for anything which is data or prior info
-    s = ""
-
-    for name in data:
-        if type(data[name]) == int:
-            s += "static const int " + name + ";\n"
-        elif type(data[name]) == float:
-            s += "static const double " + name + ";\n"
-        elif type(data[name] == np.array) and\
-            data[name].dtype.name == 'int64':
-            for i in range(0, len(data[name])):
-                s += "static const int " + name + str(i) + ";\n"
-        elif type(data[name] == np.array) and\
-            data[name].dtype.name == 'float64':
-            for i in range(0, len(data[name])):
-                s += "static const double " + name + str(i) + ";\n"
-
-    return s
+    for name, cpp_type, value in entries:
+        if type(value) is list:
+            for i in range(0, len(value)):
+                yield "static const " + cpp_type + " " + name + str(i) + ";\n"
+        else:
+            yield "static const " + cpp_type + " " + name + ";\n"
 
 def data_definition(data):
-    s = ""
-    # Static variables for anything which is data or prior info
-    for name in data:
-        if type(data[name]) == int:
-            s += "const int MyModel::" + name + " = "\
-                                       + str(data[name]) + ";\n"
-        elif type(data[name]) == float:
-            s += "const double MyModel::" + name + " = "\
-                                       + str(data[name]) + ";\n"
-        elif type(data[name] == np.array) and\
-            data[name].dtype.name == 'int64':
-            for i in range(0, len(data[name])):
-                s += "const int MyModel::" + name + str(i)\
-                                       + " = " + str(data[name][i]) + ";\n"
-        elif type(data[name] == np.array) and\
-            data[name].dtype.name == 'float64':
-            for i in range(0, len(data[name])):
-                s += "const double MyModel::" + name + str(i)\
-                                       + " = " + str(data[name][i]) + ";\n"
-    return s
-
-def generate_h(model, data):
-    f = open("MyModel.h.template")
-    s = "".join(f.readlines())
-    f.close()
-    s = s.replace("{DECLARATIONS}",
-                        model.declaration() + data_declaration(data))
-    f = open("MyModel.h", "w")
-    f.write(s)
-    f.close()
-
-def generate_cpp(model, data):
-    f = open("MyModel.cpp.template")
-    s = "".join(f.readlines())
-    f.close()
-    s = s.replace("{STATICS}",
-                        data_definition(data))
-    s = s.replace("{FROM_PRIOR}",
-                        model.from_prior())
-    s = s.replace("{PERTURB}",
-                        model.perturb())
-    s = s.replace("{LOG_LIKELIHOOD}",
-                        model.log_likelihood())
-    s = s.replace("{PRINT}",
-                        model.print())
-    s = s.replace("{DESCRIPTION}",
-                        model.description())
-    f = open("MyModel.cpp", "w")
-    f.write(s)
-    f.close()
+    return "".join(_data_definition(_data_entries(data)))
+
+def _data_definition(entries):
+    # Static variables for anything which is data or prior info,
+    # one line at a time so they can be streamed straight to a file
+    for name, cpp_type, value in entries:
+        if type(value) is list:
+            for i, x in enumerate(value):
+                yield "const " + cpp_type + " MyModel::" + name + str(i)\
+                                       + " = " + repr(x) + ";\n"
+        else:
+            yield "const " + cpp_type + " MyModel::" + name + " = "\
+                                       + repr(value) + ";\n"
 
+def _read_template(filename):
+    """
+    Return a template file split into its literal text and placeholder
+    names, alternating and starting with text. Each file is only read and
+    parsed once per session.
+    """
+    return _load_template(os.path.abspath(filename))
 
+@functools.lru_cache(maxsize=None)
+def _load_template(path):
+    with open(path) as f:
+        return tuple(_placeholder.split(f.read()))
+
+def _write_template(f, template, substitutions):
+    """
+    Write a template from _read_template to the file f, replacing every
+    placeholder with the fragments in substitutions[NAME] as they are
+    produced, so the full output never has to be held in memory.
+    Placeholders without a substitution are written as they are.
+    """
+    for i, piece in enumerate(template):
+        if i % 2 == 0:
+            f.write(piece)
+        else:
+            f.writelines(substitutions.get(piece, ["{" + piece + "}"]))
 
+def generate_h(model, data=None):
+    if data is not None:
+        model.set_data(data)
+    template = _read_template("MyModel.h.template")
+    declarations = [model.declaration()]
+    declarations.extend(_data_declaration(model._data))
+    substitutions = {"DECLARATIONS": declarations}
+    with open("MyModel.h", "w") as f:
+        _write_template(f, template, substitutions)
 
+def generate_cpp(model, data=None):
+    if data is not None:
+        model.set_data(data)
+    template = _read_template("MyModel.cpp.template")
+    substitutions = {"STATICS": _data_definition(model._data),
+                     "FROM_PRIOR": [model.from_prior()],
+                     "PERTURB": [model.perturb()],
+                     "LOG_LIKELIHOOD": [model.log_likelihood()],
+                     "PRINT": [model.print()],
+                     "DESCRIPTION": [model.description()]}
+    with open("MyModel.cpp", "w") as f:
+        _write_template(f, template, substitutions)
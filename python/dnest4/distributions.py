@@ -1,3 +1,23 @@
+import math
+import numbers
+
+def _is_number(value):
+    """
+    True if value is a numerical constant rather than a C++ expression.
+    """
+    return isinstance(value, numbers.Real)
+
+def _literal(value):
+    """
+    Format a parameter for the generated C++. Floats use repr() so they
+    survive the round trip exactly, and C++ expressions pass through.
+    """
+    if isinstance(value, numbers.Integral):
+        return str(int(value))
+    if isinstance(value, numbers.Real):
+        return repr(float(value))
+    return str(value)
+
 class Double:
     cpp_type = "double"
 
@@ -7,22 +27,21 @@ class Int:
 class Uniform(Double):
     def __init__(self, a, b):
         self.a, self.b = a, b
+        params = {"a": _literal(self.a), "b": _literal(self.b)}
 
-    def from_uniform(self):
-        s = ""
-        s += "{x} = {a} + ({b} - ({a}))*_{x};\n"
-        return self.insert_parameters(s)
+        # Parameters are fixed, so only {x} is left to fill in later
+        self._from_uniform = "{x} = %(a)s + (%(b)s - (%(a)s))*_{x};\n" % params
 
-    def log_prob(self):
-        s  = "if({x} < ({a}) || {x} > ({b}))\n"
+        s  = "if({x} < (%(a)s) || {x} > (%(b)s))\n"
         s += "    logp = -numeric_limits<double>::max();\n"
-        s += "logp += -log({b} - ({a}));\n"
-        return self.insert_parameters(s)
+        s += "logp += -log(%(b)s - (%(a)s));\n"
+        self._log_prob = s % params
+
+    def from_uniform(self):
+        return self._from_uniform
 
-    def insert_parameters(self, s):
-        s = s.replace("{a}", str(self.a))
-        s = s.replace("{b}", str(self.b))
-        return s
+    def log_prob(self):
+        return self._log_prob
 
 
 class LogUniform(Double):
@@ -31,22 +50,33 @@ class LogUniform(Double):
     """
     def __init__(self, a, b):
         self.a, self.b = a, b
+        params = {"a": _literal(self.a), "b": _literal(self.b)}
+
+        # With numerical limits, evaluate the logs here so the generated
+        # code doesn't call log() on constants
+        if _is_number(self.a) and _is_number(self.b):
+            log_ba = math.log(float(self.b)/self.a)
+            params["log_a"] = repr(math.log(self.a))
+            params["log_ba"] = repr(log_ba)
+            params["log_log_ba"] = repr(math.log(log_ba))
+        else:
+            params["log_a"] = "log(%(a)s)" % params
+            params["log_ba"] = "log((%(b)s)/(%(a)s))" % params
+            params["log_log_ba"] = "log(log((%(b)s)/(%(a)s)))" % params
+
+        s = "{x} = exp(%(log_a)s + %(log_ba)s*_{x});\n"
+        self._from_uniform = s % params
+
+        s  = "if({x} < (%(a)s) || {x} > (%(b)s))\n"
+        s += "    logp = -numeric_limits<double>::max();\n"
+        s += "logp += -log({x}) - %(log_log_ba)s;\n"
+        self._log_prob = s % params
 
     def from_uniform(self):
-        s = ""
-        s += "{x} = exp(log({a}) + log(({b})/({a}))*_{x});\n"
-        return self.insert_parameters(s)
+        return self._from_uniform
 
     def log_prob(self):
-        s  = "if({x} < ({a}) || {x} > ({b}))\n"
-        s += "    logp = -numeric_limits<double>::max();\n"
-        s += "logp += -log({x}) - log(log(({b})/({a})));\n"
-        return self.insert_parameters(s)
-
-    def insert_parameters(self, s):
-        s = s.replace("{a}", str(self.a))
-        s = s.replace("{b}", str(self.b))
-        return s
+        return self._log_prob
 
 class Exponential(Double):
     """
@@ -54,21 +84,20 @@ class Exponential(Double):
     """
     def __init__(self, mu):
         self.mu = mu
+        params = {"mu": _literal(self.mu)}
 
-    def from_uniform(self):
-        s = ""
-        s += "{x} = -({mu})*log(1.0 - _{x});\n"
-        return self.insert_parameters(s)
+        self._from_uniform = "{x} = -(%(mu)s)*log(1.0 - _{x});\n" % params
 
-    def log_prob(self):
         s  = "if({x} < 0.0)\n"
         s += "    logp = -numeric_limits<double>::max();\n"
-        s += "logp += -log({mu}) - {x}/({mu});\n"
-        return self.insert_parameters(s)
+        s += "logp += -log(%(mu)s) - {x}/(%(mu)s);\n"
+        self._log_prob = s % params
+
+    def from_uniform(self):
+        return self._from_uniform
 
-    def insert_parameters(self, s):
-        s = s.replace("{mu}", str(self.mu))
-        return s
+    def log_prob(self):
+        return self._log_prob
 
 class Normal(Double):
     """
@@ -76,22 +105,42 @@ class Normal(Double):
     """
     def __init__(self, mu, sigma):
         self.mu, self.sigma = mu, sigma
+        params = {"mu": _literal(self.mu), "sigma": _literal(self.sigma)}
+
+        s = "{x} = %(mu)s + %(sigma)s*quantile(__boost_dist, _{x});\n"
+        self._from_uniform = s % params
+
+        # Fold the normalising constant into a single number when possible
+        if _is_number(self.sigma):
+            c = -0.5*math.log(2*math.pi) - math.log(self.sigma)
+            params["log_norm"] = repr(c)
+        else:
+            params["log_norm"] = "%r - log(%s)"\
+                                % (-0.5*math.log(2*math.pi), params["sigma"])
+
+        self._log_norm = params["log_norm"]
+        self._log_kernel = "0.5*pow((({x}) - (%(mu)s))/(%(sigma)s), 2)"\
+                                % params
+        self._log_prob = "logp += %s - %s;\n"\
+                                % (self._log_norm, self._log_kernel)
 
     def from_uniform(self):
-        s = ""
-        s += "{x} = {mu} + {sigma}*quantile(__boost_dist, _{x});\n"
-        return self.insert_parameters(s)
+        return self._from_uniform
 
     def log_prob(self):
-        s = ""
-        s += "logp += -0.5*log(2*M_PI) - log({sigma}) "
-        s += "- 0.5*pow((({x}) - ({mu}))/({sigma}), 2);\n"
-        return self.insert_parameters(s)
+        return self._log_prob
 
-    def insert_parameters(self, s):
-        s = s.replace("{mu}", str(self.mu))
-        s = s.replace("{sigma}", str(self.sigma))
-        return s
+    def log_norm(self):
+        """
+        The normalising term of log_prob, which doesn't depend on {x}.
+        """
+        return self._log_norm
+
+    def log_kernel(self):
+        """
+        The part of log_prob that depends on {x}, to be subtracted.
+        """
+        return self._log_kernel
 
 class Cauchy(Double):
     """
@@ -99,22 +148,21 @@ class Cauchy(Double):
     """
     def __init__(self, mu, sigma):
         self.mu, self.sigma = mu, sigma
+        params = {"mu": _literal(self.mu), "sigma": _literal(self.sigma)}
 
-    def from_uniform(self):
-        s = ""
-        s += "{x} = {mu} + {sigma}*tan(M_PI*(_{x} - 0.5));\n"
-        return self.insert_parameters(s)
+        s = "{x} = %(mu)s + %(sigma)s*tan(M_PI*(_{x} - 0.5));\n"
+        self._from_uniform = s % params
 
-    def log_prob(self):
         s = ""
-        s += "logp += -log(M_PI) - log({sigma}) "
-        s += "-log(1.0 + pow(({x} - {mu})/({sigma}), 2));\n"
-        return self.insert_parameters(s)
+        s += "logp += -log(M_PI) - log(%(sigma)s) "
+        s += "-log(1.0 + pow(({x} - %(mu)s)/(%(sigma)s), 2));\n"
+        self._log_prob = s % params
+
+    def from_uniform(self):
+        return self._from_uniform
 
-    def insert_parameters(self, s):
-        s = s.replace("{mu}", str(self.mu))
-        s = s.replace("{sigma}", str(self.sigma))
-        return s
+    def log_prob(self):
+        return self._log_prob
 
 class Binomial(Int):
     """
@@ -122,19 +170,17 @@ class Binomial(Int):
     """
     def __init__(self, N, p):
         self.N, self.p = N, p
+        params = {"N": _literal(self.N), "p": _literal(self.p)}
 
-    def log_prob(self):
         s = ""
-        s += "logp += boost::math::lgamma<double>({N} + 1);\n"
+        s += "logp += boost::math::lgamma<double>(%(N)s + 1);\n"
         s += "logp -= boost::math::lgamma<double>({x} + 1);\n"
-        s += "logp -= boost::math::lgamma<double>({N} - ({x}) + 1);\n"
-        s += "logp += ({x})*log({p}) + ({N} - ({x}))*log(1.0 - ({p}));\n"
-        return self.insert_parameters(s)
+        s += "logp -= boost::math::lgamma<double>(%(N)s - ({x}) + 1);\n"
+        s += "logp += ({x})*log(%(p)s) + (%(N)s - ({x}))*log(1.0 - (%(p)s));\n"
+        self._log_prob = s % params
 
-    def insert_parameters(self, s):
-        s = s.replace("{N}", str(self.N))
-        s = s.replace("{p}", str(self.p))
-        return s
+    def log_prob(self):
+        return self._log_prob
 
 class Poisson(Int):
     """
@@ -142,16 +188,15 @@ class Poisson(Int):
     """
     def __init__(self, lamb):
         self.lamb = lamb
+        params = {"lamb": _literal(self.lamb)}
 
-    def log_prob(self):
         s = ""
-        s += "logp += {x}*log({lamb}) - ({lamb});\n"
+        s += "logp += {x}*log(%(lamb)s) - (%(lamb)s);\n"
         s += "logp -= boost::math::lgamma<double>({x} + 1);\n"
-        return self.insert_parameters(s)
+        self._log_prob = s % params
 
-    def insert_parameters(self, s):
-        s = s.replace("{lamb}", str(self.lamb))
-        return s
+    def log_prob(self):
+        return self._log_prob
 
 class Gamma(Double):
     """
@@ -159,33 +204,33 @@ class Gamma(Double):
     """
     def __init__(self, alpha, theta):
         self.alpha, self.theta = alpha, theta
+        params = {"alpha": _literal(self.alpha),
+                  "theta": _literal(self.theta)}
 
-    def from_uniform(self):
         s = ""
         s += "boost::math::gamma_distribution<double> "
-        s += "my_gamma_{x}({alpha}, {theta});\n" 
+        s += "my_gamma_{x}(%(alpha)s, %(theta)s);\n" 
         s += "{x} = quantile(my_gamma_{x}, _{x});\n"
-        return self.insert_parameters(s)
+        self._from_uniform = s % params
 
-    def log_prob(self):
         s = ""
-        s += "logp += -({alpha})*log({theta}) "
-        s += "- boost::math::lgamma<double>({alpha}) "
-        s += "+ ({alpha} - 1.0)*{x} - {x}/({theta});\n"
-        return self.insert_parameters(s)
+        s += "logp += -(%(alpha)s)*log(%(theta)s) "
+        s += "- boost::math::lgamma<double>(%(alpha)s) "
+        s += "+ (%(alpha)s - 1.0)*{x} - {x}/(%(theta)s);\n"
+        self._log_prob = s % params
 
-    def insert_parameters(self, s):
-        s = s.replace("{alpha}", str(self.alpha))
-        s = s.replace("{theta}", str(self.theta))
-        return s
+    def from_uniform(self):
+        return self._from_uniform
+
+    def log_prob(self):
+        return self._log_prob
 
 
 class Delta(Double):
     def __init__(self, formula):
         self.formula = formula
+        self._from_uniform = "{x} = %s;\n" % (self.formula, )
 
     def from_uniform(self):
-        s = "{x} = {formula};\n"
-        s = s.replace("{formula}", str(self.formula))
-        return s
+        return self._from_uniform
 